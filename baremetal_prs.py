@@ -6,42 +6,55 @@ associated with sideporting the PR into development.
 """
 
 import argparse
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import os
 import json
+import re
+import shutil
 import subprocess
-
+import tempfile
+import threading
+from dataclasses import dataclass
+from io import BytesIO
+
+import numpy as np
+
+try:
+    import arpy
+    from elftools.elf.constants import SH_FLAGS
+    from elftools.elf.elffile import ELFFile
+except ImportError:
+    # Fall back to parsing the output of `size`
+    arpy = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+@functools.total_ordering
+@dataclass(slots=True, frozen=True)
 class Size:
-    def __init__(self, text: int, data: int):
-        self.text = text
-        self.data = data
+    text: int
+    data: int
 
     def __eq__(self, __o: object) -> bool:
-        return self.text + self.data == __o.text + __o.data
-
-    def __ne__(self, __o: object) -> bool:
-        return not self.__eq__(__o)
+        return self.total() == __o.total()
 
     def __lt__(self, __o: object) -> bool:
-        return self.text + self.data < __o.text + __o.data
-
-    def __le__(self, __o: object) -> bool:
-        return self.__lt__(__o) or self.__eq__(__o)
-
-    def __gt__(self, __o: object) -> bool:
-        return self.text + self.data > __o.text + __o.data
+        return self.total() < __o.total()
 
-    def __ge__(self, __o: object) -> bool:
-        return self.__gt__(__o) or self.__eq__(__o)
+    def __hash__(self) -> int:
+        return hash(self.total())
 
     def __add__(self, __o: object) -> object:
-        t = self.text + __o.text
-        d = self.data + __o.data
-        return Size(t,d)
+        return Size(self.text + __o.text, self.data + __o.data)
 
     def __sub__(self, __o: object) -> object:
-        t = self.text - __o.text
-        d = self.data - __o.data
-        return Size(t,d)
+        return Size(self.text - __o.text, self.data - __o.data)
 
     def total(self):
         '''Get the total size (text + data)'''
@@ -51,104 +64,170 @@ class Size:
 # Initialise global variable for storing size of mbedtls-2.16
 mbedtls_2_16_size = Size(0,0)
 
+# Configuration used to build the library whose size is measured
+BAREMETAL_CONFIG = 'baremetal'
+BAREMETAL_CFLAGS = '--target=arm-arm-none-eabi-mcpu=cortex-m33'
+
+# Matches the count at the start of each part of `git diff --shortstat`
+_NUM_RE = re.compile(rb'(\d+)')
+
+# Sizes of previously built source trees, keyed by size_cache_key()
+size_cache = {}
+size_cache_lock = threading.Lock()
+
+# Path prefixes known not to affect the library build
+NON_BUILD_PATHS = ('tests/', 'docs/', 'ChangeLog')
+
+# Path prefixes of sources that make rebuilds by itself when they change
+INCREMENTAL_SOURCE_PATHS = ('library/', '3rdparty/')
+
+# Last commit built in each checkout (or worktree) and the size of the result
+last_builds = {}
+
+# GitHub repository (owner/name) that the PRs of each repo belong to
+GITHUB_REPOS = {
+    'mbedtls': 'Mbed-TLS/mbedtls',
+    'mbedtls-restricted': 'Mbed-TLS/mbedtls-restricted',
+}
+
+# Fields queried from GitHub's GraphQL API for every PR
+PR_GRAPHQL_FIELDS = '''
+    headRefOid
+    title
+    changedFiles
+    additions
+    deletions
+    commits { totalCount }
+    files(first: 100) { nodes { path } }
+'''
+
 class PullRequest:
     '''Class for storing information/metrics for a single PR'''
-    def __init__(self, pr_num, repo_name):
+    def __init__(self, pr_num, repo_name, repo_path, dev_oid):
         if repo_name != 'mbedtls' and repo_name != 'mbedtls-restricted':
             raise ValueError("repo_name can only be 'mbedtls' or \
                               'mbedtls-restricted' ")
         self.repo_name = repo_name # mbedtls or mbedtls-restricted
+        self.repo_path = repo_path # checkout (or worktree) to run commands in
+        self.dev_oid = dev_oid # commit of development to compare against
         self.number = pr_num[1:]
         self.score = None
 
-    def get_metrics(self):
-        '''Get and store various metrics for the PR through the GitHub CLI (gh):
+    def set_github_metrics(self, metrics):
+        '''Store the metrics for the PR returned by GitHub's GraphQL API
 
         Metrics:
+        * Title of the PR
+        * SHA of the head of the PR
         * Number of commits
         * Number of files changed
         * Which files have been changed
         * Number of lines changed (additions + deletions)
-        * The combined size of the changes (additions + deletions) for the
-          changed files between the head of the PR and development
-        * Difference in size against Mbed TLS 2.16
-        '''
-        # Checkout the PR
-        cmd = f'gh pr checkout {self.number}'
-        ret = subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL,
-                             stderr=subprocess.STDOUT)
-        if ret.returncode != 0:
-            msg = f'Could not checkout PR {self.number}.'
-            subprocess.CalledProcessError(ret, cmd, output=msg)
-
-        # Gather the PR metrics and store the JSON as a dictionary
-        cmd = 'gh pr view --json changedFiles,files,commits,additions,deletions,title'
-        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        metrics_json_str = process.communicate()[0]
-        try:
-            metrics = json.loads(metrics_json_str)
-        except:
-            print(metrics_json_str)
-            exit()
 
-        # Store  metrics from the GitHub
+        Args:
+        * metrics: dictionary of PR_GRAPHQL_FIELDS for the PR
+        '''
         self.title = metrics['title']
-        self.commits_count = len(metrics['commits'])
+        self.head_oid = metrics['headRefOid']
+        self.commits_count = metrics['commits']['totalCount']
         self.files_count = metrics['changedFiles']
         self.lines_changed = metrics['additions'] + metrics['deletions']
         self.files = []
-        for f in metrics['files']:
+        for f in metrics['files']['nodes']:
             if f['path'].startswith('ChangeLog'):
                 continue
             else:
                 self.files.append(f['path'])
 
-        if self.repo_name == 'mbedtls':
-            dev_branch = 'development'
-        else:
-            dev_branch = 'development-restricted'
+    def get_metrics(self, builds=1):
+        '''Checkout the PR and get and store the metrics that need a build or a
+        local diff. The metrics from GitHub must already have been stored with
+        set_github_metrics().
 
+        Metrics:
+        * The combined size of the changes (additions + deletions) for the
+          changed files between the head of the PR and development
+        * Difference in size against Mbed TLS 2.16
+
+        Args:
+        * builds: number of builds running concurrently, which share the CPUs
+        '''
+        # Checkout the PR. The head is checked out detached so no local
+        # branches are left behind. FETCH_HEAD is per-worktree.
+        try:
+            subprocess.run(['git', 'fetch', '--no-tags', 'origin',
+                            f'refs/pull/{self.number}/head'],
+                           cwd=self.repo_path, capture_output=True, check=True)
+            subprocess.run(['git', 'checkout', '--detach', 'FETCH_HEAD'],
+                           cwd=self.repo_path, capture_output=True, check=True)
+        except subprocess.CalledProcessError:
+            print(f'Could not checkout PR {self.number}.')
+            raise
+
+        # Get the total line counts for all changed files in one go. The output
+        # is a single summary line such as
+        # ' 3 files changed, 10 insertions(+), 2 deletions(-)'
         total_add = 0
         total_del = 0
-        for f in self.files:
-            cmd = f'git diff --shortstat HEAD..{dev_branch} -- {f}'
-            process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-            diff = ((process.communicate()[0]).decode('UTF-8')).split(',')
-            if process.returncode != 0:
-                msg = f'Could not get diff for HEAD..{self.repo_name} for \
-                      PR {self.number}'
-                print(msg)
-                raise subprocess.CalledProcessError(process.returncode, cmd, msg)
-            for s in diff:
-                if s == '':
-                    number = 0
-                else:
-                    number = int(''.join(i for i in s.strip() if i.isdigit()))
-                if s.endswith('(+)'):
+        if self.files:
+            cmd = ['git', 'diff', '--shortstat', f'HEAD..{self.dev_oid}',
+                   '--'] + self.files
+            try:
+                ret = subprocess.run(cmd, cwd=self.repo_path,
+                                     capture_output=True, check=True)
+            except subprocess.CalledProcessError:
+                print(f'Could not get diff for HEAD..{self.dev_oid} for '
+                      f'PR {self.number}')
+                raise
+            for s in ret.stdout.strip().split(b','):
+                m = _NUM_RE.search(s)
+                number = int(m.group(1)) if m else 0
+                if s.endswith(b'(+)'):
                     total_add += number
-                if s.endswith('(-)'):
+                elif s.endswith(b'(-)'):
                     total_del += number
         self.dev_diff = total_add + total_del
 
         # Calculate the difference in bytes to 2.16
-        pr_size = get_baremetal_size()
-        self.bytes_saved = mbedtls_2_16_size - pr_size
+        self.size = get_baremetal_size(self.repo_path, builds)
+        self.bytes_saved = mbedtls_2_16_size - self.size
 
 class PullRequestGetter:
     '''Tools to checkout all specified PRs and get their metrics'''
-    def __init__(self, pulls_path, mbedtls_path, restricted_path):
+    def __init__(self, pulls_path, mbedtls_path, restricted_path, jobs=8,
+                 cache_path=None):
         # Convert possibly relative paths to absolute paths and store them
         self.mbedtls_path = os.path.abspath(mbedtls_path)
         self.restricted_path = os.path.abspath(restricted_path)
-
-        # Make sure mbedtls/development is up-to-date
-        subprocess.run('git checkout development; git pull',
-                       cwd=self.mbedtls_path, shell=True)
-        # Make sure mbedtls-restricted/development-restricted is up-to-date
-        subprocess.run('git checkout development-restricted; git pull',
-                       cwd=self.restricted_path, shell=True)
+        # Number of PRs to process concurrently
+        self.jobs = jobs
+        # JSON file storing metrics from previous runs (None to disable)
+        self.cache_path = cache_path
+        self._load_cache(cache_path)
+
+        # Make sure mbedtls/development and
+        # mbedtls-restricted/development-restricted are up-to-date
+        for repo_path, dev_branch in [
+                (self.mbedtls_path, 'development'),
+                (self.restricted_path, 'development-restricted')]:
+            try:
+                subprocess.run(['git', 'checkout', dev_branch], cwd=repo_path,
+                               capture_output=True, check=True)
+                subprocess.run(['git', 'pull'], cwd=repo_path,
+                               capture_output=True, check=True)
+            except subprocess.CalledProcessError as e:
+                print(f'Could not update {dev_branch} in {repo_path}:')
+                print(e.stderr.decode('UTF-8'))
+                raise
+
+        # Resolve development once so that every PR is compared against the
+        # same commit. Metrics against it from previous runs can only be
+        # reused until it moves on.
+        self.dev_oids = {
+            'mbedtls': get_oid('development', self.mbedtls_path),
+            'mbedtls-restricted': get_oid('development-restricted',
+                                          self.restricted_path),
+        }
 
         # Extract PR numbers from the JSON file
         self.mbedtls_pulls = []
@@ -157,10 +236,14 @@ class PullRequestGetter:
             pulls = txt_file.read().strip().split('\n')
             for pr_number in pulls:
                 if pr_number.startswith('#'):
-                    pr_object = PullRequest(pr_number,'mbedtls')
+                    pr_object = PullRequest(pr_number,'mbedtls',
+                                            self.mbedtls_path,
+                                            self.dev_oids['mbedtls'])
                     self.mbedtls_pulls.append(pr_object)
                 elif pr_number.startswith('r'):
-                    pr_object = PullRequest(pr_number,'mbedtls-restricted')
+                    pr_object = PullRequest(pr_number,'mbedtls-restricted',
+                                            self.restricted_path,
+                                            self.dev_oids['mbedtls-restricted'])
                     self.restricted_pulls.append(pr_object)
                 else:
                     msg = f"PR Numbers should start with:\n \
@@ -169,6 +252,70 @@ class PullRequestGetter:
                             repository\n {pr_number} begins with neither."
                     raise ValueError(msg)
 
+        # Get the GitHub metrics for all PRs up front
+        self.get_github_metrics('mbedtls')
+        self.get_github_metrics('mbedtls-restricted')
+
+    def get_github_metrics(self, repo_name):
+        '''Get the GitHub metrics for every PR of a repository with a single
+        GraphQL query, using one aliased pullRequest field per PR.'''
+        if repo_name == 'mbedtls':
+            repo_path = self.mbedtls_path
+            repo_pulls = self.mbedtls_pulls
+        elif repo_name == 'mbedtls-restricted':
+            repo_path = self.restricted_path
+            repo_pulls = self.restricted_pulls
+        if not repo_pulls:
+            return
+
+        pulls_query = '\n'.join(f'pr{pr.number}: pullRequest(number: {pr.number}) '
+                                f'{{{PR_GRAPHQL_FIELDS}}}'
+                                for pr in repo_pulls)
+        query = f'''query($owner: String!, $name: String!) {{
+                        repository(owner: $owner, name: $name) {{
+                            {pulls_query}
+                        }}
+                    }}'''
+        # Name the repository explicitly so that gh doesn't have to work it
+        # out from the git remotes of the repository in cwd
+        owner, name = GITHUB_REPOS[repo_name].split('/')
+        env = {**os.environ, 'GH_REPO': GITHUB_REPOS[repo_name]}
+        cmd = ['gh', 'api', 'graphql', '-F', f'owner={owner}',
+               '-F', f'name={name}', '-f', f'query={query}']
+        try:
+            out = subprocess.run(cmd, cwd=repo_path, env=env,
+                                 capture_output=True, check=True).stdout
+        except subprocess.CalledProcessError as e:
+            print(f'Could not query PR metrics for {repo_name}:')
+            print(e.stderr.decode('UTF-8'))
+            raise
+        metrics = json_loads(out)['data']['repository']
+        for pr in repo_pulls:
+            pr.set_github_metrics(metrics[f'pr{pr.number}'])
+
+    def _load_cache(self, path):
+        '''Load the metrics cache from a JSON file, if there is one'''
+        self.cache = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as cache_file:
+                self.cache = json_loads(cache_file.read())
+
+    def _save_cache(self, path):
+        '''Save the metrics cache to a JSON file'''
+        if path is None:
+            return
+        with open(path, 'w') as cache_file:
+            json.dump(self.cache, cache_file, indent=4)
+
+    def _cache_key(self, pr):
+        '''Get the cache key for a PR. The metrics stored under it are valid
+        for as long as neither the PR nor development (nor how they are
+        built) change.'''
+        key = f'{pr.repo_name}|{pr.number}|{pr.head_oid}|' \
+              f'{self.dev_oids[pr.repo_name]}|' \
+              f'{BAREMETAL_CONFIG}|{BAREMETAL_CFLAGS}'
+        return hashlib.sha1(key.encode()).hexdigest()
+
     def print_pulls(self):
         print("Public PRs:")
         for pr in self.mbedtls_pulls:
@@ -186,59 +333,186 @@ class PullRequestGetter:
         elif repo_name == 'mbedtls-restricted':
             repo_path = self.restricted_path
             repo_pulls = self.restricted_pulls
-        os.chdir(repo_path)
+        # Reuse the metrics of PRs that are unchanged since a previous run
+        pending_pulls = []
         for pr in repo_pulls:
+            cached = self.cache.get(self._cache_key(pr))
+            if cached is None:
+                pending_pulls.append(pr)
+                continue
+            pr.dev_diff = cached['dev_diff']
+            # Only the PR's own size is cached, as the 2.16 size may differ
+            pr.size = Size(*cached['size'])
+            pr.bytes_saved = mbedtls_2_16_size - pr.size
             text = f'{pr.repo_name}/{pr.number}'
             spacing = '.' * (40- len(text))
-            print(f'{text} {spacing} ', end='')
-            pr.get_metrics()
-
-            if pr.commits_count > self.max_commits:
-                self.max_commits = pr.commits_count
-            if pr.files_count > self.max_files_count:
-                self.max_files_count = pr.files_count
-            if pr.lines_changed > self.max_lines_changed:
-                self.max_lines_changed = pr.lines_changed
-            if pr.dev_diff > self.max_dev_diff:
-                self.max_dev_diff = pr.dev_diff
-            if pr.bytes_saved > self.max_bytes_saved:
-                self.max_bytes_saved = pr.bytes_saved
-
-            print('DONE')
+            print(f'{text} {spacing} CACHED')
+
+        if pending_pulls:
+            # Sort PRs that touch similar files next to each other, so that
+            # they end up built one after the other in the same worktree
+            pending_pulls.sort(key=lambda pr: sorted(pr.files))
+            self.get_pending_metrics(repo_name, repo_path,
+                                     self.dev_oids[repo_name], pending_pulls)
+            for pr in pending_pulls:
+                self.cache[self._cache_key(pr)] = {
+                    'dev_diff': pr.dev_diff,
+                    'size': [pr.size.text, pr.size.data],
+                }
+            self._save_cache(self.cache_path)
+
+    def add_worktrees(self, repo_name, repo_path, dev_oid, count):
+        '''Create worktrees of a repository for the workers to checkout PRs in
+
+        Worktrees share the object store of the main clone, so this is much
+        cheaper than a clone per worker.
+
+        Returns:
+        * The directory containing the worktrees
+        * A list of paths to the worktrees
+        '''
+        # Forget about worktrees left behind by interrupted runs
+        subprocess.run(['git', 'worktree', 'prune'], cwd=repo_path,
+                       capture_output=True, check=True)
+        worktrees_dir = tempfile.mkdtemp(prefix=f'{repo_name}-worktrees-')
+        worktrees = []
+        try:
+            for i in range(count):
+                worktree_path = os.path.join(worktrees_dir, f'w{i}')
+                subprocess.run(['git', 'worktree', 'add', '-f', '--detach',
+                                worktree_path, dev_oid],
+                               cwd=repo_path, capture_output=True, check=True)
+                worktrees.append(worktree_path)
+        except:
+            # Don't leave the worktrees created so far behind
+            self.remove_worktrees(repo_path, worktrees_dir, worktrees)
+            raise
+        return worktrees_dir, worktrees
+
+    def remove_worktrees(self, repo_path, worktrees_dir, worktrees):
+        '''Remove the worktrees created by add_worktrees()'''
+        for worktree_path in worktrees:
+            subprocess.run(['git', 'worktree', 'remove', '--force',
+                            worktree_path],
+                           cwd=repo_path, capture_output=True)
+        shutil.rmtree(worktrees_dir, ignore_errors=True)
+        subprocess.run(['git', 'worktree', 'prune'], cwd=repo_path,
+                       capture_output=True)
+
+    def get_pending_metrics(self, repo_name, repo_path, dev_oid, pulls):
+        '''Checkout and get the metrics of PRs in parallel
+
+        The PRs are split into contiguous chunks, one queue per worker, and
+        each worker processes its queue in order. Neighbouring PRs in the list
+        therefore build one after the other in the same worktree, which lets
+        get_baremetal_size() reuse the previous build. As the cost of a PR
+        varies from a cache hit to a clean build, a worker that runs out of
+        work takes PRs from the end of the longest remaining queue.
+        '''
+        # Give each worker its own worktree so that concurrent checkouts and
+        # builds don't fight over HEAD
+        builds = min(self.jobs, len(pulls))
+        worktrees_dir, worktrees = self.add_worktrees(
+            repo_name, repo_path, dev_oid, builds)
+        chunk_size, extra = divmod(len(pulls), builds)
+        queues = []
+        start = 0
+        for i in range(builds):
+            end = start + chunk_size + (1 if i < extra else 0)
+            queues.append(collections.deque(pulls[start:end]))
+            start = end
+        queues_lock = threading.Lock()
+
+        def next_pr(own_queue):
+            with queues_lock:
+                if own_queue:
+                    return own_queue.popleft()
+                # Take the PR furthest from where its own worker has got to
+                longest_queue = max(queues, key=len)
+                if longest_queue:
+                    return longest_queue.pop()
+                return None
+
+        def get_queue_metrics(worktree_path, own_queue):
+            while (pr := next_pr(own_queue)) is not None:
+                pr.repo_path = worktree_path
+                try:
+                    pr.get_metrics(builds)
+                finally:
+                    pr.repo_path = repo_path
+                text = f'{pr.repo_name}/{pr.number}'
+                spacing = '.' * (40- len(text))
+                print(f'{text} {spacing} DONE')
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=builds) \
+                    as executor:
+                futures = [executor.submit(get_queue_metrics, worktree_path,
+                                           own_queue)
+                           for worktree_path, own_queue in zip(worktrees,
+                                                               queues)]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+        finally:
+            self.remove_worktrees(repo_path, worktrees_dir, worktrees)
 
     def get_metrics(self):
         '''Get metrics for all PRs'''
-        self.max_commits = 0
-        self.max_files_count = 0
-        self.max_lines_changed = 0
-        self.max_dev_diff = 0
-        self.max_bytes_saved = Size(0,0)
-
         print('Calculating metrics for all specified PRs...')
-        # Get current working directory so we can come back to it
-        cwd = os.getcwd()
-
         # Get metrics for public PRs
         self.get_metrics_by_repo('mbedtls')
 
         # Get metrics for restricted PRs
         self.get_metrics_by_repo('mbedtls-restricted')
 
-        # Go back to old cwd
-        os.chdir(cwd)
+        # Metrics are normalised against their maximum (or 0 if all negative)
+        all_pulls = (self.mbedtls_pulls + self.restricted_pulls)
+        self.max_commits = max([0] + [pr.commits_count for pr in all_pulls])
+        self.max_files_count = max([0] + [pr.files_count for pr in all_pulls])
+        self.max_lines_changed = max([0] + [pr.lines_changed
+                                            for pr in all_pulls])
+        self.max_dev_diff = max([0] + [pr.dev_diff for pr in all_pulls])
+        self.max_bytes_saved = max([Size(0,0)] + [pr.bytes_saved
+                                                  for pr in all_pulls])
 
     def normalise_metric(self, pr_val, max_val):
-        return (pr_val / max_val) * 100
+        # A metric whose maximum is 0 doesn't tell the PRs apart, so it
+        # normalises to 0 for all of them
+        pr_val = np.asarray(pr_val, dtype=float)
+        ratio = np.divide(pr_val, max_val, out=np.zeros_like(pr_val),
+                          where=np.asarray(max_val) != 0)
+        return ratio * 100
 
     def normalise_metrics(self):
-        for pr in (self.mbedtls_pulls + self.restricted_pulls):
-            norm_metrics = {}
-            norm_metrics['commits'] = self.normalise_metric(pr.commits_count, self.max_commits)
-            norm_metrics['files_count'] = self.normalise_metric(pr.files_count, self.max_files_count)
-            norm_metrics['lines_changed'] = self.normalise_metric(pr.lines_changed, self.max_lines_changed)
-            norm_metrics['dev_diff'] = self.normalise_metric(pr.dev_diff, self.max_dev_diff)
-            norm_metrics['bytes_saved'] = self.normalise_metric(pr.bytes_saved.total(), self.max_bytes_saved.total())
-            pr.score = calculate_score(norm_metrics)
+        all_pulls = (self.mbedtls_pulls + self.restricted_pulls)
+        if not all_pulls:
+            return
+        # One row per PR, with one column per metric
+        raw = np.array([[pr.commits_count, pr.files_count, pr.lines_changed,
+                         pr.dev_diff, pr.bytes_saved.total()]
+                        for pr in all_pulls], dtype=float)
+        max_metrics = np.array([self.max_commits, self.max_files_count,
+                                self.max_lines_changed, self.max_dev_diff,
+                                self.max_bytes_saved.total()], dtype=float)
+
+        # Score all PRs at once, with one array per normalised metric
+        norm = self.normalise_metric(raw, max_metrics)
+        norm_metrics = {}
+        norm_metrics['commits'] = norm[:, 0]
+        norm_metrics['files_count'] = norm[:, 1]
+        norm_metrics['lines_changed'] = norm[:, 2]
+        norm_metrics['dev_diff'] = norm[:, 3]
+        norm_metrics['bytes_saved'] = norm[:, 4]
+        # The score divides by the PR's average cost, so it is undefined for
+        # a PR whose cost metrics are all 0
+        zero = norm[:, :4].sum(axis=1) == 0
+        if zero.any():
+            pr = all_pulls[np.flatnonzero(zero)[0]]
+            raise ValueError(f'Cannot score {pr.repo_name}/{pr.number}: its '
+                             'commits, files, lines changed and dev diff are '
+                             'all 0')
+        for pr, score in zip(all_pulls, calculate_score(norm_metrics)):
+            pr.score = float(score)
 
     def print_pulls(self):
         print("Public PRs:")
@@ -281,6 +555,7 @@ def check_args(args):
 
     Checks that the .txt path is valid and points to a text file.
     Checks that the repo paths are valid and point to git repositories.
+    Checks that the number of jobs is positive (or -1 for all CPUs).
 
     Args:
     * args: object containing arguments passed to script
@@ -293,43 +568,164 @@ def check_args(args):
         if not os.path.exists(path):
             raise ValueError(f'{path}: No such file or directory')
         else:
-            ret = subprocess.run(f'cd {path}; git status', shell=True,
+            ret = subprocess.run(['git', 'status'], cwd=path,
                                     stdout=subprocess.DEVNULL,
                                     stderr=subprocess.STDOUT)
             if ret.returncode != 0:
                 raise ValueError(f'{path} is not a path to a git repository.')
 
-def get_baremetal_size(repo_path='./'):
+    if args.jobs < 1 and args.jobs != -1:
+        raise ValueError(f'--jobs must be a positive integer or -1, not {args.jobs}')
+
+def get_oid(rev, repo_path='./'):
+    '''Get the object ID that a revision resolves to in a repository'''
+    return subprocess.check_output(['git', 'rev-parse', rev],
+                                   cwd=repo_path).decode('UTF-8').strip()
+
+def size_cache_key(tree_oid):
+    '''Get the key under which the size of a source tree is cached. The size
+    only depends on the tree and the configuration it is built with.'''
+    return f'{tree_oid}|{BAREMETAL_CONFIG}|{BAREMETAL_CFLAGS}'
+
+def load_size_cache(path):
+    '''Load sizes of previously built source trees from a JSON file'''
+    if path is not None and os.path.exists(path):
+        with open(path) as cache_file:
+            for key, (text, data) in json_loads(cache_file.read()).items():
+                size_cache[key] = Size(text, data)
+
+def save_size_cache(path):
+    '''Save the sizes of all source trees built so far to a JSON file'''
+    if path is None:
+        return
+    with size_cache_lock:
+        sizes = {key: [size.text, size.data]
+                 for key, size in size_cache.items()}
+    with open(path, 'w') as cache_file:
+        json.dump(sizes, cache_file, indent=4)
+
+def get_baremetal_size(repo_path='./', builds=1):
+    '''Get the size of the library built from the checked out source tree,
+    only building it if that tree hasn't been built before
+
+    When the previous build in the same checkout differs only in files known
+    not to affect the library (NON_BUILD_PATHS), its size is reused. When the
+    other changed files are all C sources of the library, the objects it left
+    behind are reused and make rebuilds just the changed ones. Any other
+    change (headers, Makefiles and their includes, generators under scripts/,
+    ...) still needs a clean build, as the Makefiles don't track them.
+
+    Args:
+    * repo_path: path to the checkout (or worktree) to build in
+    * builds: number of builds running concurrently, which share the CPUs
+    '''
     abs_path = os.path.abspath(repo_path)
-    build_cmds = '''make clean;
-                    ./scripts/config.pl baremetal;
-                    make lib CC=armclang CFLAGS="--target=arm-arm-none-eabi-mcpu=cortex-m33"
-                    git restore include/mbedtls/config.h'''
-    ret = subprocess.run(build_cmds, shell=True,cwd=abs_path,
-                         stdout=subprocess.DEVNULL,
-                         stderr=subprocess.STDOUT)
-    if ret.returncode != 0:
-        raise subprocess.CalledProcessError(ret.returncode, build_cmds,
-                                            'Could not build mbedtls')
-
-    process = subprocess.Popen('size -t library/libmbedcrypto.a', shell=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT,
-                                cwd=abs_path)
-    totals = process.communicate()[0].decode('UTF-8').split('\n')[-2].split('\t')
-    return Size(int(totals[0]),int(totals[1]))
+    key = size_cache_key(get_oid('HEAD^{tree}', abs_path))
+    with size_cache_lock:
+        size = size_cache.get(key)
+        last_build = last_builds.get(abs_path)
+    if size is not None:
+        return size
+
+    head_oid = get_oid('HEAD', abs_path)
+    clean = True
+    if last_build is not None:
+        last_oid, last_size = last_build
+        changed = subprocess.run(['git', 'diff', '--name-only', last_oid,
+                                  head_oid],
+                                 cwd=abs_path, capture_output=True,
+                                 check=True).stdout.decode('UTF-8').splitlines()
+        changed = [f for f in changed if not f.startswith(NON_BUILD_PATHS)]
+        if not changed:
+            size = last_size
+        elif all(f.endswith('.c') and f.startswith(INCREMENTAL_SOURCE_PATHS)
+                 for f in changed):
+            clean = False
+    if size is None:
+        size = build_baremetal_size(abs_path, clean, builds)
+
+    with size_cache_lock:
+        size_cache[key] = size
+        last_builds[abs_path] = (head_oid, size)
+    return size
+
+def build_baremetal_size(repo_path='./', clean=True, builds=1):
+    '''Build the library and measure its size
+
+    Args:
+    * repo_path: path to the checkout (or worktree) to build in
+    * clean: whether to remove the objects of a previous build first
+    * builds: number of builds running concurrently, which share the CPUs
+    '''
+    abs_path = os.path.abspath(repo_path)
+    # Objects of files unchanged since a previous build come from ccache
+    cc = 'ccache armclang' if shutil.which('ccache') else 'armclang'
+    build_cmds = [['make', 'clean']] if clean else []
+    build_cmds += [['./scripts/config.pl', BAREMETAL_CONFIG],
+                  ['make', 'lib', f'-j{max(1, os.cpu_count() // builds)}',
+                   f'CC={cc}', f'CFLAGS={BAREMETAL_CFLAGS}']]
+    try:
+        for cmd in build_cmds:
+            subprocess.run(cmd, cwd=abs_path, capture_output=True, check=True)
+    except subprocess.CalledProcessError:
+        print(f'Could not build mbedtls in {abs_path}')
+        raise
+    finally:
+        subprocess.run(['git', 'restore', 'include/mbedtls/config.h'],
+                       cwd=abs_path)
+
+    archive_path = os.path.join(abs_path, 'library', 'libmbedcrypto.a')
+    if arpy is None:
+        out = subprocess.run(['size', '-t', archive_path],
+                             capture_output=True, check=True).stdout
+        totals = out.decode('UTF-8').split('\n')[-2].split('\t')
+        return Size(int(totals[0]),int(totals[1]))
+    return get_archive_size(archive_path)
+
+def get_archive_size(archive_path):
+    '''Sum the section sizes of all objects in a static library the same way
+    as `size`: allocated read-only sections count as text, and allocated
+    writable sections with contents count as data.'''
+    text = 0
+    data = 0
+    with arpy.Archive(archive_path) as archive:
+        for member in archive:
+            contents = member.read()
+            # Skip the symbol and long name tables
+            if not contents.startswith(b'\x7fELF'):
+                continue
+            for section in ELFFile(BytesIO(contents)).iter_sections():
+                flags = section['sh_flags']
+                if not flags & SH_FLAGS.SHF_ALLOC or \
+                   section['sh_type'] == 'SHT_NOBITS':
+                    continue
+                if flags & SH_FLAGS.SHF_WRITE:
+                    data += section['sh_size']
+                else:
+                    text += section['sh_size']
+    return Size(text, data)
 
 def calculate_mbedtls_2_16_size(mbedtls_path):
     abs_path = os.path.abspath(mbedtls_path)
-    cmd = '''git fetch origin archive/mbedtls-2.16;
-             git checkout archive/mbedtls-2.16'''
-    ret = subprocess.run(cmd, shell=True, cwd=abs_path,
-                         stdout=subprocess.DEVNULL,
-                         stderr=subprocess.STDOUT)
-    if ret.returncode != 0:
-        raise subprocess.CalledProcessError(ret.returncode,cmd,
-                                            'Could not checkout mbedtls-2.16')
     global mbedtls_2_16_size
+    try:
+        subprocess.run(['git', 'fetch', 'origin', 'archive/mbedtls-2.16'],
+                       cwd=abs_path, capture_output=True, check=True)
+    except subprocess.CalledProcessError:
+        print('Could not fetch mbedtls-2.16')
+        raise
+    # Skip the checkout and build entirely if 2.16 has been built before
+    key = size_cache_key(get_oid('FETCH_HEAD^{tree}', abs_path))
+    if key in size_cache:
+        mbedtls_2_16_size = size_cache[key]
+        return
+
+    try:
+        subprocess.run(['git', 'checkout', 'archive/mbedtls-2.16'],
+                       cwd=abs_path, capture_output=True, check=True)
+    except subprocess.CalledProcessError:
+        print('Could not checkout mbedtls-2.16')
+        raise
     mbedtls_2_16_size = get_baremetal_size(mbedtls_path)
 
 def main():
@@ -343,15 +739,34 @@ def main():
     parser.add_argument('restricted_path', metavar='MBEDTLS_RESTRICTED_PATH',
                         help='''Path to the root of the mbedtls-restricted
                                 repository''')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='''Number of PRs to process in parallel
+                                (-1 to use all CPUs, default: 8)''')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='''Don't reuse or store metrics from previous
+                                runs''')
     # parser.add_argument('--no-checkout', action='store_true',
     #                     help="Don't checkout all PRs before collecting metrics.\
     #                      Use this when you already have all PRs locally.")
     args = parser.parse_args()
 
     check_args(args)
-    calculate_mbedtls_2_16_size(args.mbedtls_path)
-    pr_getter = PullRequestGetter(args.pulls_path, args.mbedtls_path, args.restricted_path)
-    pr_getter.get_metrics()
+    jobs = os.cpu_count() if args.jobs == -1 else args.jobs
+    # Keep the caches next to the list of PRs
+    if args.no_cache:
+        cache_path = None
+        size_cache_path = None
+    else:
+        cache_path = os.path.splitext(args.pulls_path)[0] + '.cache.json'
+        size_cache_path = os.path.splitext(args.pulls_path)[0] + '.sizes.cache.json'
+    load_size_cache(size_cache_path)
+    try:
+        calculate_mbedtls_2_16_size(args.mbedtls_path)
+        pr_getter = PullRequestGetter(args.pulls_path, args.mbedtls_path,
+                                      args.restricted_path, jobs, cache_path)
+        pr_getter.get_metrics()
+    finally:
+        save_size_cache(size_cache_path)
     pr_getter.normalise_metrics()
     pr_getter.generate_report()
 